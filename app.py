@@ -1,86 +1,213 @@
+import functools
+import re
+from array import array
+from typing import NamedTuple
+import numpy as np
 import streamlit as st
 import fitz  # PyMuPDF
-from io import BytesIO
-from reportlab.pdfgen import canvas
-from reportlab.graphics.barcode import code128
-from reportlab.lib.pagesizes import letter
+
+# Item numbers: 7–9 digits starting with 3
+_ITEM_RE = re.compile(r"3\d{6,8}").fullmatch
+
+# Item numbers must start left of this x; extraction is clipped a little wider
+# so that most numbers starting near the limit lie wholly inside the clip.
+ITEM_MAX_X = 200
+ITEM_CLIP_X = ITEM_MAX_X + 150
+
+class ItemCoords(NamedTuple):
+    """Detected item numbers as parallel arrays: entry k is items[k] at (xs[k], ys[k]) on pages[k]."""
+    pages: np.ndarray  # int32
+    items: list  # item number strings
+    xs: np.ndarray  # float32
+    ys: np.ndarray  # float32
+
+# Text extraction flags: item numbers are plain digits, so MuPDF need not
+# preserve ligatures or whitespace characters while building words.
+WORDS_FLAGS = fitz.TEXTFLAGS_WORDS & ~(fitz.TEXT_PRESERVE_LIGATURES | fitz.TEXT_PRESERVE_WHITESPACE)
 
 def find_item_coordinates(pdf):
     """Find 7–9 digit item numbers starting with 3 in the left margin (x < 200)."""
-    coords = []
+    # typed arrays keep the numbers unboxed while the total count is unknown
+    pages, items, xs, ys = array("i"), [], array("f"), array("f")
+    is_item = _ITEM_RE  # local lookup in the hot loop
     for i, page in enumerate(pdf):
-        for block in page.get_text("dict")["blocks"]:
-            for line in block.get("lines", []):
-                for span in line.get("spans", []):
-                    t = span["text"].strip()
-                    if (
-                        t.isdigit()
-                        and t.startswith("3")
-                        and 7 <= len(t) <= 9
-                        and span["bbox"][0] < 200
-                    ):
-                        coords.append((i, t, span["bbox"][0], span["bbox"][1]))
-    return coords
-
-def overlay_barcodes(pdf, items):
+        # "words" yields flat (x0, y0, x1, y1, text, ...) tuples; MuPDF does the span walk,
+        # and the clip drops the rest of the page before any Python objects are built.
+        # get_text works in unrotated space, so the clip uses the cropbox, not page.rect.
+        clip = fitz.Rect(0, 0, ITEM_CLIP_X, page.cropbox.height)
+        words = page.get_text("words", clip=clip, flags=WORDS_FLAGS)
+        # MuPDF clips characters, not words, so a word ending within about one
+        # character (its own height) of the clip edge may have been cut short,
+        # e.g. "312345678" coming back as "31234567". Rescan such pages unclipped
+        # so a truncated number is never accepted.
+        if any(w[0] < ITEM_MAX_X and w[2] + (w[3] - w[1]) >= ITEM_CLIP_X for w in words):
+            words = page.get_text("words", flags=WORDS_FLAGS)
+        for x0, y0, x1, y1, t, *_ in words:
+            # cheap x-coordinate test first, so most words never reach the regex
+            if x0 < ITEM_MAX_X and is_item(t):
+                pages.append(i)
+                items.append(t)
+                xs.append(x0)
+                ys.append(y0)
+    return ItemCoords(
+        np.frombuffer(pages, np.int32) if pages else np.empty(0, np.int32),
+        items,
+        np.frombuffer(xs, np.float32) if xs else np.empty(0, np.float32),
+        np.frombuffer(ys, np.float32) if ys else np.empty(0, np.float32),
+    )
+
+# Code128 module widths (bar, space, bar, ...) for symbol values 0-106; 106 is the stop code
+_CODE128_PATTERNS = (
+    "212222", "222122", "222221", "121223", "121322", "131222", "122213", "122312",
+    "132212", "221213", "221312", "231212", "112232", "122132", "122231", "113222",
+    "123122", "123221", "223211", "221132", "221231", "213212", "223112", "312131",
+    "311222", "321122", "321221", "312212", "322112", "322211", "212123", "212321",
+    "232121", "111323", "131123", "131321", "112313", "132113", "132311", "211313",
+    "231113", "231311", "112133", "112331", "132131", "113123", "113321", "133121",
+    "313121", "211331", "231131", "213113", "213311", "213131", "311123", "311321",
+    "331121", "312113", "312311", "332111", "314111", "221411", "431111", "111224",
+    "111422", "121124", "121421", "141122", "141221", "112214", "112412", "122114",
+    "122411", "142112", "142211", "241211", "221114", "413111", "241112", "134111",
+    "111242", "121142", "121241", "114212", "124112", "124211", "411212", "421112",
+    "421211", "212141", "214121", "412121", "111143", "111341", "131141", "114113",
+    "114311", "411113", "411311", "113141", "114131", "311141", "411131", "211412",
+    "211214", "211232", "2331112",
+)
+_START_C, _CODE_B, _STOP = 105, 100, 106
+
+@functools.lru_cache(maxsize=4096)
+def code128_pattern(item):
+    """
+    Module widths of item's Code128 symbol, alternating bar/space starting with a bar.
+    Item numbers are all digits, so they are encoded as Set C digit pairs, with a
+    trailing odd digit switched to Set B (the same symbol reportlab produces).
+    """
+    values = [_START_C]
+    values += [int(item[i:i + 2]) for i in range(0, len(item) - 1, 2)]
+    if len(item) % 2:
+        values += [_CODE_B, int(item[-1]) + 16]  # Set B digits start at value 16
+    checksum = (values[0] + sum(i * v for i, v in enumerate(values[1:], 1))) % 103
+    values += [checksum, _STOP]
+    return tuple(int(w) for v in values for w in _CODE128_PATTERNS[v])
+
+@functools.lru_cache(maxsize=4096)
+def code128_bars(item, bar_width):
+    """
+    Return (symbol_width, bars) for item's Code128 symbol, where bars is a tuple
+    of (x, width) black bars measured from the symbol's left edge (no quiet zone).
+    Cached, so every caller drawing the same item shares one encoding.
+    """
+    bars = []
+    x = 0.0
+    for k, modules in enumerate(code128_pattern(item)):
+        w = modules * bar_width
+        if k % 2 == 0:
+            bars.append((x, w))
+        x += w
+    return x, tuple(bars)
+
+def overlay_barcodes(pdf, coords):
     """
     Draw high-quality, wide, light Code128 barcodes on the right side,
     mimicking the clean style of the original top-right barcode.
     """
-    for page_index, item, x, y in items:
-        page = pdf[page_index]
+    # Use a larger width and height to mimic the native barcode's size and spacing
+    barcode_width_pt = 300  # Increased width for more quiet zone and readability
+    barcode_height_pt = 80  # Increased height for better scanning
+    bar_width = 1.5  # Significantly wider bars for better scanning
+    font_size = 12
+
+    # --- Target placement: right side, same vertical level as item
+    # We'll place barcode centered around x=500 with breathing room
+
+    # Place the barcode with a generous margin from the right edge
+    right_edge = 612  # Letter size page width
+    margin = 30  # 30pt margin from the right edge
+    left = right_edge - barcode_width_pt - margin
+
+    # Ensure it doesn't go off-page
+    if left < 0:
+        left = 0
+
+    # White background (larger than barcode for ample quiet zone)
+    bg_margin = 15  # Extra margin for the white background
+    bg_pad = bg_margin + 0.5  # plus half the 1pt outline the background used to have
+    bg_w = barcode_width_pt + 2 * bg_pad
+    bg_h = barcode_height_pt + 2 * bg_pad
 
-        # --- Target placement: right side, same vertical level as item
-        # We'll place barcode centered around x=500 with breathing room
-        # Use a larger width and height to mimic the native barcode's size and spacing
-
-        barcode_width_pt = 300  # Increased width for more quiet zone and readability
-        barcode_height_pt = 80  # Increased height for better scanning
-
-        # Place the barcode with a generous margin from the right edge
-        right_edge = 612  # Letter size page width
-        margin = 30  # 30pt margin from the right edge
-        left = right_edge - barcode_width_pt - margin
-        right = right_edge - margin
-        top = y - 25  # Adjust vertical position for better alignment
-        bottom = top + barcode_height_pt
-
-        # Ensure it doesn't go off-page
-        if left < 0:
-            left = 0
-            right = barcode_width_pt
-
-        # --- White background (larger than barcode for ample quiet zone) ---
-        bg_margin = 15  # Extra margin for the white background
-        bg_rect = fitz.Rect(left - bg_margin, top - bg_margin, right + bg_margin, bottom + bg_margin)
-        page.draw_rect(bg_rect, color=(1, 1, 1), fill=(1, 1, 1))
-
-        # --- Generate barcode as a separate high-res PDF ---
-        buf = BytesIO()
-        tmp_canvas = canvas.Canvas(buf, pagesize=(barcode_width_pt, barcode_height_pt))
-
-        # Create barcode with much wider bars for high readability
-        barcode = code128.Code128(
-            item,
-            barHeight=barcode_height_pt - 30,  # leave margin at top and bottom
-            barWidth=1.5,                      # Significantly wider bars for better scanning
-            humanReadable=True                 # optional: show number below
-        )
-        # Center the barcode horizontally in its canvas
-        barcode_width_actual = barcode.width
-        x_offset = (barcode_width_pt - barcode_width_actual) / 2
-        barcode.drawOn(tmp_canvas, x_offset, 15)  # Add margin at bottom
-        tmp_canvas.save()
-
-        buf.seek(0)
-        img_pdf = fitz.open("pdf", buf.read())
-
-        # --- Embed barcode PDF into main page ---
-        target_rect = fitz.Rect(left, top, right, bottom)
-        page.show_pdf_page(target_rect, img_pdf, 0)
+    # --- Build each unique item's content stream once ---
+    # Drawn in the background's own coordinates (origin bottom-left, y up), so a
+    # placement only needs a "cm" in front of it. Bars are centered horizontally,
+    # leaving 15pt at top and 15pt for the human-readable number below them.
+    items = coords.items
+    streams = {}
+    for item in items:
+        if item in streams:
+            continue
+        symbol_width, bars = code128_bars(item, bar_width)
+        text_width = fitz.get_text_length(item, fontname="cour", fontsize=font_size)
+        u0 = bg_pad + (barcode_width_pt - symbol_width) / 2
+        v0 = bg_pad + 15
+        bar_h = barcode_height_pt - 30
+        baseline = v0 - 1.07 * 0.629 * font_size  # Courier ascent, as reportlab places it
+        streams[item] = "".join((
+            f"1 1 1 rg\n0 0 {bg_w:g} {bg_h:g} re f\n0 0 0 rg\n",
+            "".join(f"{u0 + bx:g} {v0:g} {bw:g} {bar_h:g} re\n" for bx, bw in bars),
+            f"f\nBT\n/cour {font_size:g} Tf\n{u0 + (symbol_width - text_width) / 2:g} {baseline:g} Td\n",
+            f"({item}) Tj\nET\n",
+        ))
+
+    # Vertical extents for every placement at once
+    tops = coords.ys.astype(np.float64) - 25  # Adjust vertical position for better alignment
+    bottoms = tops + barcode_height_pt
+    bottoms, page_indices = bottoms.tolist(), coords.pages.tolist()
+
+    # --- One content stream per page: each placement is "q <cm> <item stream> Q",
+    # appended in document order so overlapping barcodes stack as before.
+    # Items arrive in page order from the scan.
+    k = 0
+    n = len(items)
+    while k < n:
+        page_index = page_indices[k]
+        page = pdf[page_index]
+        page.insert_font(fontname="cour")  # resource used by the streams' text
+        ipctm = ~page.transformation_matrix  # page (top-down) -> PDF (bottom-up)
+        parts = []
+        while k < n and page_indices[k] == page_index:
+            m = fitz.Matrix(1, 0, 0, -1, left - bg_pad, bottoms[k] + bg_pad) * ipctm
+            parts.append(f"q\n{m.a:g} {m.b:g} {m.c:g} {m.d:g} {m.e:g} {m.f:g} cm\n")
+            parts.append(streams[items[k]])
+            parts.append("Q\n")
+            k += 1
+        shape = page.new_shape()
+        shape.totalcont = "".join(parts)
+        shape.commit(overlay=True)
 
     return pdf
 
+# --- Cached per upload: Streamlit reruns the whole script on every widget change ---
+@st.cache_data(show_spinner=False, max_entries=16)
+def scan_ticket(pdf_bytes):
+    """find_item_coordinates for a PDF given as bytes, computed once per distinct upload."""
+    pdf = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        # Plain tuple, not ItemCoords: cache_data pickles the result, and Streamlit swaps
+        # the script's __main__ module on every run, so the class may be stale by then.
+        return tuple(find_item_coordinates(pdf))
+    finally:
+        pdf.close()
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def annotate_ticket(pdf_bytes):
+    """Bytes of the PDF with barcodes overlaid, computed once per distinct upload."""
+    pdf = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        overlay_barcodes(pdf, ItemCoords(*scan_ticket(pdf_bytes)))
+        # garbage=4/clean drop unused and duplicate objects; deflate compresses streams.
+        return pdf.tobytes(garbage=4, clean=True, deflate=True, deflate_images=True)
+    finally:
+        pdf.close()
+
 # --- Streamlit UI ---
 st.set_page_config(page_title="Picking Ticket Barcode Generator", layout="centered")
 st.title("📦 Picking Ticket Barcode Generator")
@@ -95,23 +222,31 @@ st.write(
 uploaded_file = st.file_uploader("Upload Picking Ticket PDF", type=["pdf"])
 
 if uploaded_file:
-    pdf = fitz.open(stream=uploaded_file.read(), filetype="pdf")
-    with st.spinner("🔍 Analyzing picking ticket..."):
-        items = find_item_coordinates(pdf)
+    # getvalue() always returns the whole upload, whatever the stream position left
+    # by an earlier rerun; read() would return only what follows it. The bytes
+    # also key the caches above.
+    pdf_bytes = uploaded_file.getvalue()
+    # Remember this upload's results in the session, keyed by Streamlit's file id,
+    # so later reruns skip hashing the whole PDF to look up the caches.
+    if st.session_state.get("upload_id") != uploaded_file.file_id:
+        with st.spinner("🔍 Analyzing picking ticket..."):
+            st.session_state.ticket_items = ItemCoords(*scan_ticket(pdf_bytes)).items
+        st.session_state.upload_id = uploaded_file.file_id
+        st.session_state.pop("ticket_output", None)
+    items = st.session_state.ticket_items
 
     if not items:
         st.error("❌ No valid item numbers found (7–9 digits, starting with '3', in left margin).")
     else:
         st.success(f"✅ Found {len(items)} item number(s).")
         if st.checkbox("Show detected item numbers"):
-            st.write([i[1] for i in items])
+            st.write(items)
 
         if st.button("🖨️ Generate Barcode PDF"):
-            with st.spinner("🖨️ Generating high-quality barcodes..."):
-                out_pdf = overlay_barcodes(pdf, items)
-                output = BytesIO()
-                out_pdf.save(output)
-                output.seek(0)
+            if "ticket_output" not in st.session_state:
+                with st.spinner("🖨️ Generating high-quality barcodes..."):
+                    st.session_state.ticket_output = annotate_ticket(pdf_bytes)
+            output = st.session_state.ticket_output
 
             st.success("✅ Ready to download!")
             st.download_button(
@@ -120,5 +255,3 @@ if uploaded_file:
                 file_name="picking_ticket_with_barcodes.pdf",
                 mime="application/pdf"
             )
-
-    pdf.close()
@@ -0,0 +1,82 @@
+import fitz
+import pytest
+
+import app
+
+# Known answers from reportlab's Code128 encoder: item -> (checksum value, module widths)
+KNOWN = {
+    "3100000": (101, "2112322123212122222122221141311231223111412331112"),
+    "31000007": (61, "2112322123212122222122221223122214112331112"),
+    "310000071": (45, "2112322123212122222122221223121141311232211131232331112"),
+    "3999999": (31, "2112322113131131411131411141313211222123212331112"),
+    "398979695": (19, "2112322113132121411341111122141141312132122211322331112"),
+    "30123456": (73, "2112322121231122321311233311211421122331112"),
+}
+
+@pytest.mark.parametrize("item", sorted(KNOWN))
+def test_code128_pattern_known_answers(item):
+    checksum, widths = KNOWN[item]
+    pattern = app.code128_pattern(item)
+    assert "".join(map(str, pattern)) == widths
+    # the symbol before the 7-element stop code is the checksum
+    assert "".join(map(str, pattern[-13:-7])) == app._CODE128_PATTERNS[checksum]
+
+def test_code128_pattern_table():
+    table = app._CODE128_PATTERNS
+    assert len(table) == 107
+    assert len(set(table)) == 107
+    # every symbol is 3 bars + 3 spaces over 11 modules; the stop code adds a 2-module bar
+    for value, widths in enumerate(table[:-1]):
+        assert len(widths) == 6 and sum(map(int, widths)) == 11, value
+    assert table[-1] == "2331112"
+
+def _ticket(*words, rotation=0):
+    """In-memory one-page PDF with each (x, y, text[, fontsize]) drawn at that point."""
+    pdf = fitz.open()
+    page = pdf.new_page(width=612, height=792)
+    for x, y, text, *size in words:
+        page.insert_text((x, y), text, fontsize=size[0] if size else 10)
+    page.set_rotation(rotation)
+    return pdf
+
+def test_item_cut_by_clip_is_not_truncated():
+    # at 36pt this number runs past ITEM_CLIP_X; the clipped word alone reads "31234567"
+    pdf = _ticket((190, 100, "312345678", 36))
+    assert app.find_item_coordinates(pdf).items == ["312345678"]
+
+COLUMN = [(40, 60 + r * 55, f"{3100000 + r}") for r in range(13)]  # down the whole page
+
+@pytest.mark.parametrize("rotation", [0, 90, 180, 270])
+def test_find_items_on_rotated_pages(rotation):
+    coords = app.find_item_coordinates(_ticket(*COLUMN, rotation=rotation))
+    assert coords.items == [text for _, _, text in COLUMN]
+    assert coords.pages.tolist() == [0] * len(COLUMN)
+
+def test_find_items_with_offset_cropbox():
+    pdf = _ticket(*[(x + 100, y + 50, text) for x, y, text in COLUMN])
+    pdf[0].set_cropbox(fitz.Rect(100, 50, 612, 792))
+    coords = app.find_item_coordinates(pdf)
+    assert coords.items == [text for _, _, text in COLUMN]
+    # coordinates are relative to the visible page
+    assert coords.xs.tolist() == [40] * len(COLUMN)
+
+def test_find_items_left_margin_cutoff():
+    pdf = _ticket(
+        (app.ITEM_MAX_X - 1, 100, "3100001"),
+        (app.ITEM_MAX_X, 200, "3100002"),
+        (40, 300, "4100003"),  # does not start with 3
+        (40, 400, "310000"),  # too short
+    )
+    assert app.find_item_coordinates(pdf).items == ["3100001"]
+
+@pytest.mark.parametrize("rotation", [0, 90])
+def test_overlay_prints_number_beside_each_item(rotation):
+    pdf = _ticket((40, 100, "3100001"), (40, 300, "31000022"), (40, 500, "310000333"), rotation=rotation)
+    coords = app.find_item_coordinates(pdf)
+    app.overlay_barcodes(pdf, coords)
+    page = pdf[0]
+    for item, y in zip(coords.items, coords.ys.tolist()):
+        # the barcode's human-readable line sits in the right-hand box level with the
+        # item (text extraction works in unrotated coordinates, like the scan)
+        box = fitz.Rect(250, y - 25, 612, y + 55)
+        assert [w[4] for w in page.get_text("words", clip=box)] == [item]